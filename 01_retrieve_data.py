@@ -1,26 +1,30 @@
 import os
-import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
+import orjson
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from tqdm import tqdm
 from google.cloud import storage
-from time import sleep
 
 import config
 
 
 def retrieve_file_from_google_storage_anonymous(
-    bucket_name: str, file_name: str, destination_file_name: str = None
+    bucket: storage.Bucket, file_name: str, destination_file_name: str = None
 ) -> None:
     """
     Retrieve file from google storage and save it to local disk
-    :param bucket_name: name of the bucket
+    :param bucket: bucket of an anonymous storage client
     :param file_name: name of the file to be saved
     :param destination_file_name: name of the file to be saved
     :return: None
     """
-    storage_client = storage.Client.create_anonymous_client()
-    bucket = storage_client.get_bucket(bucket_name)
     blob = bucket.blob(file_name)
     blob.download_to_filename(destination_file_name)
 
@@ -66,23 +70,97 @@ def load_openaip_data(
         bucket_name=bucket_name, postfix=postfix
     )
 
-    for file in tqdm(
-        oaip_files, desc="Downloading OpenAIP Data", total=len(oaip_files), unit="files"
-    ):
-        if os.path.exists(os.path.join(data_folder, file)):
-            continue
+    existing = set(os.listdir(data_folder))
+    remaining = [file for file in oaip_files if file not in existing]
+
+    # share one client between all downloads, its connections are reused across files
+    storage_client = storage.Client.create_anonymous_client()
+    bucket = storage_client.bucket(bucket_name)
+
+    def download_file(file: str) -> None:
         retrieve_file_from_google_storage_anonymous(
-            bucket_name=bucket_name,
+            bucket=bucket,
             file_name=file,
             destination_file_name=os.path.join(data_folder, file),
         )
 
+    with ThreadPoolExecutor(max_workers=config.openaip_download_workers) as executor:
+        try:
+            for _ in tqdm(
+                executor.map(download_file, remaining),
+                desc="Downloading OpenAIP Data",
+                total=len(remaining),
+                unit="files",
+            ):
+                pass
+        except BaseException:
+            # drop the queued downloads on an error or Ctrl-C instead of fetching them all before stopping
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+class RateLimiter:
+    """
+    Simple thread-safe rate limiter that spaces out calls to at most `rate` calls per second.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self) -> None:
+        """
+        Blocks the calling thread until it is allowed to perform its call.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def make_osm_session(num_workers: int) -> requests_cache.CachedSession:
+    """
+    Creates a requests session with connection pooling, retries and an on-disk response cache for the Overpass API.
+    The request body is part of the cache key, so every query and bounding box is cached separately.
+    :param num_workers: number of threads sharing the session
+    :return: configured session
+    """
+    retry = Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 503],
+        raise_on_status=False,
+        allowed_methods=frozenset(["GET", "POST"]),
+    )
+    adapter = HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers, max_retries=retry)
+
+    session = requests_cache.CachedSession(
+        config.osm_cache_file,
+        backend="sqlite",
+        expire_after=config.osm_cache_expire_after_s,
+        allowable_methods=["GET", "POST"],
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 
 def execute_osm_query_for_bbox(
-    query: str, lat_min: float, lon_min: float, lat_max: float, lon_max: float
+    session: requests_cache.CachedSession,
+    rate_limiter: RateLimiter,
+    query: str,
+    lat_min: float,
+    lon_min: float,
+    lat_max: float,
+    lon_max: float,
 ) -> dict:
     """
     Retrieve OSM data from Overpass API for a given bounding box
+    :param session: session used to send the request
+    :param rate_limiter: spaces out the requests which are not answered from the cache
     :param lat_min: minimum latitude
     :param lon_min: minimum longitude
     :param lat_max: maximum latitude
@@ -98,7 +176,16 @@ def execute_osm_query_for_bbox(
         "data": query.replace("$bbox$", f"{lat_min}, {lon_min}, {lat_max}, {lon_max}")
     }
 
-    response = requests.post(config.osm_query_url, data=payload, headers=headers)
+    request = session.prepare_request(requests.Request("POST", config.osm_query_url, data=payload, headers=headers))
+    # send() skips the proxy and CA bundle settings from the environment which post() would apply
+    settings = session.merge_environment_settings(request.url, {}, None, None, None)
+
+    # only requests going to the server count against the rate limit, cached responses are returned right away
+    cached_response = session.cache.get_response(session.cache.create_key(request, **settings))
+    if cached_response is None or cached_response.is_expired:
+        rate_limiter.wait()
+
+    response = session.send(request, **settings)
 
     if response.status_code != 200:
         print(
@@ -106,7 +193,7 @@ def execute_osm_query_for_bbox(
         )
         return None
 
-    return response.json()
+    return orjson.loads(response.content)
 
 
 def make_world_bounding_boxes():
@@ -120,26 +207,44 @@ def make_world_bounding_boxes():
         four values: the starting latitude, starting longitude, ending latitude,
         and ending longitude of the bounding box.
     """
-    bounding_boxes = []
-    for lat_div in range(config.num_lat_divisions):
-        for lon_div in range(config.num_lon_divisions):
-            # Calculate latitude and longitude ranges for the bounding box
-            lat_start = -90 + (lat_div * (180 / config.num_lat_divisions))
-            lat_end = -90 + ((lat_div + 1) * (180 / config.num_lat_divisions))
-            lon_start = -180 + (lon_div * (360 / config.num_lon_divisions))
-            lon_end = -180 + ((lon_div + 1) * (360 / config.num_lon_divisions))
+    # the edges use the same arithmetic as the file names of earlier downloads, np.linspace could differ in the last digit
+    lat_edges = -90 + np.arange(config.num_lat_divisions + 1) * (180 / config.num_lat_divisions)
+    lon_edges = -180 + np.arange(config.num_lon_divisions + 1) * (360 / config.num_lon_divisions)
+
+    lat_start, lon_start = np.meshgrid(lat_edges[:-1], lon_edges[:-1], indexing="ij")
+    lat_end, lon_end = np.meshgrid(lat_edges[1:], lon_edges[1:], indexing="ij")
+    bounding_boxes = np.stack([lat_start, lon_start, lat_end, lon_end], axis=-1).reshape(-1, 4)
+
+    # convert to tuples of python floats, they are used in the file names of the downloaded data
+    return [tuple(bounding_box) for bounding_box in bounding_boxes.tolist()]
+
+
+def download_data_for_bbox(
+    bbox: tuple, query: str, folder: str, session: requests_cache.CachedSession, rate_limiter: RateLimiter
+) -> bool:
+    """
+    Downloads the OSM data of a query for a bounding box and saves it to `folder`.
+
+    Returns:
+        True if data was downloaded, False if the query failed.
+    """
+    filename = os.path.join(folder, f"{bbox}.json")
+
+    # Retrieve data for the bounding box, spacing out requests to avoid overloading the server
+    data = execute_osm_query_for_bbox(session, rate_limiter, query, *bbox)
+    if data is None:
+        return False
 
-            # Create bounding box coordinates
-            bounding_box = (lat_start, lon_start, lat_end, lon_end)
+    # Save the data to a file
+    with open(filename, "wb") as f:
+        f.write(orjson.dumps(data))
 
-            # Use the bounding box for your specific purpose (e.g., querying data within the box)
-            bounding_boxes.append(bounding_box)
-    return bounding_boxes
+    return True
 
 
 def load_osm_data(data_folder: str):
     """
-    Downloads OSM data for helipads and hospitals in the world and saves it to a local folder.
+    Downloads OSM data for helipads, hospitals and offshore platforms in the world and saves it to a local folder.
 
     Args:
         data_folder (str): The path to the folder where the downloaded data will be saved.
@@ -147,74 +252,38 @@ def load_osm_data(data_folder: str):
     Returns:
         None
     """
-    # function code here
-
-
-def load_osm_data(data_folder: str):
     bounding_boxes = make_world_bounding_boxes()
 
-    def download_data_for_bbox(bbox, data_folder, query, data_type) -> bool:
+    jobs = []
+    for query, data_type in [
+        (config.heli_query, "heli"),
+        (config.hospital_query, "hospital"),
+        (config.offshore_query, "offshore"),
+    ]:
         folder = os.path.join(data_folder, data_type)
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        filename = f"{bbox}.json"
-        if os.path.exists(os.path.join(folder, filename)):
-            return False
-
-        # Retrieve data for the bounding box
-        data = execute_osm_query_for_bbox(query, *bbox)
-
-        # Save the data to a file
-        with open(os.path.join(folder, filename), "w") as f:
-            json.dump(data, f)
-
-        return True
-
-    for bbox in tqdm(
-        bounding_boxes,
-        desc="Downloading OSM Helipad Data",
-        total=len(bounding_boxes),
-        unit="files",
-    ):
-        if (
-            download_data_for_bbox(bbox, data_folder, config.heli_query, "heli")
-            == False
-        ):
-            continue
-
-        # Sleep to avoid overloading the server
-        sleep(0.5)
-
-    for bbox in tqdm(
-        bounding_boxes,
-        desc="Downloading OSM Hospital Data",
-        total=len(bounding_boxes),
-        unit="files",
-    ):
-        if (
-            download_data_for_bbox(bbox, data_folder, config.hospital_query, "hospital")
-            == False
-        ):
-            continue
-
-        # Sleep to avoid overloading the server
-        sleep(0.5)
-
-    for bbox in tqdm(
-        bounding_boxes,
-        desc="Downloading OSM Offshore Data",
-        total=len(bounding_boxes),
-        unit="files",
-    ):
-        if (
-            download_data_for_bbox(bbox, data_folder, config.offshore_query, "offshore")
-            == False
-        ):
-            continue
-
-        # Sleep to avoid overloading the server
-        sleep(0.5)
+        # list the folder once instead of checking every bounding box file on its own
+        existing = set(os.listdir(folder))
+        jobs += [(bbox, query, folder) for bbox in bounding_boxes if f"{bbox}.json" not in existing]
+
+    session = make_osm_session(config.osm_download_workers)
+    rate_limiter = RateLimiter(config.osm_requests_per_second)
+    with ThreadPoolExecutor(max_workers=config.osm_download_workers) as executor:
+        futures = [executor.submit(download_data_for_bbox, *job, session, rate_limiter) for job in jobs]
+        try:
+            for future in tqdm(
+                as_completed(futures),
+                desc="Downloading OSM Data",
+                total=len(futures),
+                unit="files",
+            ):
+                future.result()
+        except BaseException:
+            # drop the queued downloads on an error or Ctrl-C instead of sending them all before stopping
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
 
 if __name__ == "__main__":
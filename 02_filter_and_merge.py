@@ -1,137 +1,262 @@
 import os
-import json
-from math import radians, cos, sin, atan2, sqrt
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count, get_context
 
+import ijson
+import orjson
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
-from sklearn.neighbors import BallTree
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from scipy.spatial import cKDTree
 
 import config
 
 
-def filter_openaip_files_for_type(source_directory: str, destination_directory: str) -> None:
+def list_json_files(directory: str) -> list:
     """
-    Filters OpenAIP files in the specified directory for entries of type 7 ("Heliport civil") or 4 ("Heliport Military), and saves the filtered data to a new file
-    in a subdirectory called 'filtered'.
+    Returns the names of all JSON files in the directory, scanning it only once.
+    """
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries if entry.is_file() and entry.name.endswith(".json")]
 
-    Args:
-        directory (str): The path to the directory containing the OpenAIP files to filter.
 
-    Returns:
-        None
+HELIPAD_SCHEMA = pa.schema(
+    [("lat", pa.float64()), ("lon", pa.float64()), ("source", pa.string()), ("info_json", pa.string())]
+)
+
+# OpenAIP airport types of heliports and the operator we report for them
+OPENAIP_HELIPORT_OPERATORS = {7: "Civil", 4: "Military"}
+
+
+def write_table(table: pa.Table, destination_file: str) -> None:
     """
-    if not os.path.exists(destination_directory):
-        os.makedirs(destination_directory)
-    for filename in tqdm(
-        os.listdir(source_directory),
-        desc="Filtering OpenAIP Data",
-        total=len(os.listdir(source_directory)),
-        unit="files",
-    ):
-        if not filename.endswith(".json"):
-            continue
-        with open(os.path.join(source_directory, filename), mode="rb") as file:
-            data = json.load(file)
+    Saves the data as parquet file and, if `config.write_debug_csv` is set, as CSV file next to it.
+    """
+    pq.write_table(
+        table,
+        destination_file,
+        compression=config.parquet_compression,
+        row_group_size=config.parquet_row_group_size,
+        use_dictionary=True,
+    )
+    if config.write_debug_csv:
+        pa_csv.write_csv(table, destination_file.replace(".parquet", ".csv"))
 
-            out_data = []
-            for entry in data:
-                if entry["type"] == 7 or entry["type"] == 4:
-                    out_data.append(entry)
 
-            with open(os.path.join(destination_directory, filename), "w+") as filtered_file:
-                filtered_file.write(json.dumps(out_data, ensure_ascii=False))
+def make_helipad_batch(lats: list, lons: list, source: str, infos: list) -> pa.RecordBatch:
+    """
+    Builds a record batch with the helipad schema from the column values of one file.
+    """
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array(lats, type=pa.float64()),
+            pa.array(lons, type=pa.float64()),
+            pa.array([source] * len(lats), type=pa.string()),
+            pa.array(infos, type=pa.string()),
+        ],
+        schema=HELIPAD_SCHEMA,
+    )
+
+
+def parse_openaip_file(path: str) -> pa.RecordBatch:
+    """
+    Parses an OpenAIP file into a record batch of lat, lon, source and info_json, keeping only entries of type 7
+    ("Heliport civil") or 4 ("Heliport Military").
+    """
+    with open(path, mode="rb") as file:
+        json_data = orjson.loads(file.read())
+
+    # build the columns with one comprehension each instead of appending row by row
+    heliports = [entry for entry in json_data if entry["type"] in OPENAIP_HELIPORT_OPERATORS]
+    lats = [entry["geometry"]["coordinates"][1] for entry in heliports]
+    lons = [entry["geometry"]["coordinates"][0] for entry in heliports]
+    infos = [
+        orjson.dumps(
+            {
+                "icaoCode": entry.get("icaoCode", ""),
+                "name": entry["name"],
+                "operator": OPENAIP_HELIPORT_OPERATORS[entry["type"]],
+                "elevation": entry["elevation"]["value"] if "elevation" in entry else "",
+            }
+        ).decode()
+        for entry in heliports
+    ]
+    return make_helipad_batch(lats, lons, "OpenAIP", infos)
+
+
+def parse_osm_file(path: str) -> pa.RecordBatch:
+    """
+    Parses an OSM helipad file into a record batch of lat, lon, source and info_json. Overpass responses can be large,
+    so the elements are streamed one at a time instead of loading the whole document.
+    """
+    lats, lons, infos = [], [], []
+    with open(path, mode="rb") as file:
+        for entry in ijson.items(file, "elements.item", use_float=True):
+            lat = None
+            lon = None
+            if entry["type"] == "node":
+                lat = entry["lat"]
+                lon = entry["lon"]
+            elif entry["type"] == "way" or entry["type"] == "relation":
+                lat = entry["center"]["lat"]
+                lon = entry["center"]["lon"]
+
+            tags = entry.get("tags") or {}
+            lats.append(lat)
+            lons.append(lon)
+            infos.append(
+                orjson.dumps(
+                    {
+                        "name": tags.get("name", ""),
+                        "icaoCode": tags.get("icao", ""),
+                        "surface": tags.get("surface", ""),
+                        "operator": tags.get("operator:type", ""),
+                        "description": tags.get("description", ""),
+                        "elevation": tags.get("ele", ""),
+                    }
+                ).decode()
+            )
+    return make_helipad_batch(lats, lons, "OSM", infos)
+
+
+def _parse_indexed_file(job: tuple) -> tuple:
+    """
+    Runs the parse function of a (index, parse_file, path) job and returns the result together with the index.
+    """
+    index, parse_file, path = job
+    return index, parse_file(path)
+
+
+def parse_files_in_parallel(paths: list, parse_file, desc: str) -> pa.Table:
+    """
+    Parses the files with `parse_file` in a process pool and returns the record batches of all files as one table.
+    """
+    jobs = [(index, parse_file, path) for index, path in enumerate(paths)]
+    batches = [None] * len(paths)
+
+    # spawn gives the workers a clean interpreter instead of forking the parent's state. Files are handed out in
+    # completion order to keep all workers busy and put back into file order afterwards, so the output is deterministic.
+    with get_context("spawn").Pool(cpu_count()) as pool:
+        for index, batch in tqdm(
+            pool.imap_unordered(_parse_indexed_file, jobs, chunksize=8),
+            desc=desc,
+            total=len(jobs),
+            unit="files",
+        ):
+            batches[index] = batch
+
+    return pa.Table.from_batches(batches, schema=HELIPAD_SCHEMA)
 
 
 def transform_openaip_data(source_directory: str, destination_file: str) -> None:
     """
-    Transforms OpenAIP data from the specified directory into a CSV file containing the following columns:
+    Filters the OpenAIP data from the specified directory for heliports and transforms it in the same pass into a file
+    containing the following columns:
     - lat (float): The latitude of the helipad.
     - lon (float): The longitude of the helipad.
     - source (str): The source of the data.
     - info_json (str): Additional data in JSON representation.
     """
-    data = []
-    for filename in tqdm(
-        os.listdir(source_directory),
-        desc="Transforming OpenAIP Data",
-        total=len(os.listdir(source_directory)),
-        unit="files",
-    ):
-        if not filename.endswith(".json"):
-            continue
-        with open(os.path.join(source_directory, filename)) as file:
-            json_data = json.loads(file.read())
-            for entry in json_data:
-                data.append(
-                    [
-                        entry["geometry"]["coordinates"][1],
-                        entry["geometry"]["coordinates"][0],
-                        "OpenAIP",
-                        json.dumps(
-                            {
-                                "icaoCode": entry["icaoCode"] if "icaoCode" in entry else "",
-                                "name": entry["name"],
-                                "operator": "Civil" if entry["type"] == 7 else "Military",
-                                "elevation": entry["elevation"]["value"] if "elevation" in entry else "",
-                            }
-                        ),
-                    ]
-                )
-    df = pd.DataFrame(data=data, columns=["lat", "lon", "source", "info_json"])
-    df.to_parquet(destination_file)
-    df.to_csv(destination_file.replace(".parquet", ".csv"), index=False)
+    paths = [os.path.join(source_directory, filename) for filename in list_json_files(source_directory)]
+    table = parse_files_in_parallel(paths, parse_openaip_file, desc="Transforming OpenAIP Data")
+    write_table(table, destination_file)
 
 
 def transform_osm_helipad_data(source_directory: str, destination_file: str) -> None:
     """
-    Transforms OpenAIP data from the specified directory into a CSV file containing the following columns:
+    Transforms OSM data from the specified directory into a file containing the following columns:
     - lat (float): The latitude of the helipad.
     - lon (float): The longitude of the helipad.
     - source (str): The source of the data.
     - info_json (str): Additional data in JSON representation.
     """
-    data = []
-    for filename in tqdm(
-        os.listdir(source_directory),
-        desc="Transforming OSM Data",
-        total=len(os.listdir(source_directory)),
-        unit="files",
-    ):
-        if not filename.endswith(".json"):
-            continue
-        with open(os.path.join(source_directory, filename)) as file:
-            json_data = json.loads(file.read())
-            for entry in json_data["elements"]:
-                lat = None
-                lon = None
-                if entry["type"] == "node":
-                    lat = entry["lat"]
-                    lon = entry["lon"]
-                elif entry["type"] == "way" or entry["type"] == "relation":
-                    lat = entry["center"]["lat"]
-                    lon = entry["center"]["lon"]
-
-                data.append(
-                    [
-                        lat,
-                        lon,
-                        "OSM",
-                        json.dumps(
-                            {
-                                "name": entry["tags"]["name"] if "name" in entry["tags"] else "",
-                                "icaoCode": entry["tags"]["icao"] if "icao" in entry["tags"] else "",
-                                "surface": entry["tags"]["surface"] if "surface" in entry["tags"] else "",
-                                "operator": entry["tags"]["operator:type"] if "operator:type" in entry["tags"] else "",
-                                "description": entry["tags"]["description"] if "description" in entry["tags"] else "",
-                                "elevation": entry["tags"]["ele"] if "ele" in entry["tags"] else "",
-                            }
-                        ),
-                    ]
-                )
-    df = pd.DataFrame(data=data, columns=["lat", "lon", "source", "info_json"])
-    df.to_parquet(destination_file)
-    df.to_csv(destination_file.replace(".parquet", ".csv"), index=False)
+    paths = [os.path.join(source_directory, filename) for filename in list_json_files(source_directory)]
+    table = parse_files_in_parallel(paths, parse_osm_file, desc="Transforming OSM Data")
+    write_table(table, destination_file)
+
+
+def _coordinates(data: pd.DataFrame) -> tuple:
+    """
+    Returns the lat and lon columns of the data as separate contiguous float64 arrays.
+    """
+    return data["lat"].to_numpy(dtype=np.float64), data["lon"].to_numpy(dtype=np.float64)
+
+
+def _unit_sphere_xyz(lat_deg: np.ndarray, lon_deg: np.ndarray) -> np.ndarray:
+    """
+    Converts latitudes and longitudes into cartesian coordinates on the unit sphere.
+    """
+    lat = np.radians(lat_deg)
+    lon = np.radians(lon_deg)
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def _haversine(lat1, lon1, cos_lat1, lat2, lon2, cos_lat2) -> np.ndarray:
+    """
+    Returns the haversine of the central angle between points given in radians, broadcasting over the inputs. It grows
+    monotonically with the distance, so thresholds can be compared without the arcsin and sqrt of the full formula.
+    The cosines of the latitudes are passed in to compute them once per point instead of once per pair.
+    """
+    return np.sin((lat2 - lat1) / 2) ** 2 + cos_lat1 * cos_lat2 * np.sin((lon2 - lon1) / 2) ** 2
+
+
+def _proximity_brute_force(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray, distance_threshold_m: float
+) -> np.ndarray:
+    """
+    Returns a mask of the points 2 which are within the distance threshold of any of the points 1 by computing the
+    haversine distance to every candidate in the latitude band around each point 1.
+    """
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    cos_lat1 = np.cos(lat1)
+
+    # the latitude difference never exceeds the great circle distance, so the band holds all possible matches
+    order = np.argsort(lat2)
+    lat2_sorted = lat2[order]
+    lon2_sorted = lon2[order]
+    cos_lat2_sorted = np.cos(lat2_sorted)
+    max_angle = distance_threshold_m / config.earth_radius_m
+    starts = np.searchsorted(lat2_sorted, lat1 - max_angle, side="left")
+    ends = np.searchsorted(lat2_sorted, lat1 + max_angle, side="right")
+
+    max_haversine = np.sin(max_angle / 2) ** 2
+    proximity_sorted = np.zeros(len(lat2), dtype=bool)
+    for i in range(len(lat1)):
+        band = slice(starts[i], ends[i])
+        haversine = _haversine(
+            lat1[i], lon1[i], cos_lat1[i], lat2_sorted[band], lon2_sorted[band], cos_lat2_sorted[band]
+        )
+        proximity_sorted[band] |= haversine <= max_haversine
+
+    proximity = np.empty_like(proximity_sorted)
+    proximity[order] = proximity_sorted
+    return proximity
+
+
+def _proximity_spatial_tree(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray, distance_threshold_m: float
+) -> np.ndarray:
+    """
+    Returns a mask of the points 2 which are within the distance threshold of any of the points 1 using a k-d tree.
+    """
+    spatial_tree = cKDTree(_unit_sphere_xyz(lat1, lon1))
+
+    # on the unit sphere the chord length grows monotonically with the great circle distance,
+    # so the euclidean query radius below selects exactly the same points as the haversine distance
+    chord_threshold = 2 * np.sin((distance_threshold_m / config.earth_radius_m) / 2)
+
+    # the tree holds points 1, so a bounded nearest neighbour query of all points 2 in one call gives the mask directly;
+    # it reports points beyond the bound as infinitely far, the bound is nudged up to keep points exactly at the threshold
+    distances, _ = spatial_tree.query(
+        _unit_sphere_xyz(lat2, lon2),
+        k=1,
+        distance_upper_bound=np.nextafter(chord_threshold, np.inf),
+        workers=config.proximity_query_workers,
+    )
+    return np.isfinite(distances)
 
 
 def check_for_proximity(data1: pd.DataFrame, data2: pd.DataFrame, distance_threshold_m: float) -> pd.DataFrame:
@@ -139,27 +264,34 @@ def check_for_proximity(data1: pd.DataFrame, data2: pd.DataFrame, distance_thres
     Checks if the entries in data1 are within a distance threshold of the entries in data2. We return data2 with an additional column
     called 'proximity' which is True if the entry is within the distance threshold of any entry in data1.
     """
-    spatial_tree = spatial_tree = BallTree(
-        [(radians(coord["lat"]), radians(coord["lon"])) for _, coord in data2.iterrows()], metric="haversine"
-    )
-
-    data2["proximity"] = False
+    lat1, lon1 = _coordinates(data1)
+    lat2, lon2 = _coordinates(data2)
+
+    # for small inputs building the tree costs more than comparing the candidates directly, the brute force loops over
+    # data1 so its length is capped as well
+    if (
+        len(data1) <= config.proximity_brute_force_max_queries
+        and len(data1) * len(data2) <= config.proximity_brute_force_max_pairs
+    ):
+        data2["proximity"] = _proximity_brute_force(lat1, lon1, lat2, lon2, distance_threshold_m)
+    else:
+        data2["proximity"] = _proximity_spatial_tree(lat1, lon1, lat2, lon2, distance_threshold_m)
 
-    # merge the data
-    with tqdm(total=len(data1), desc="Checking for proximity") as pbar:
-        for _, coord1 in data1.iterrows():
-            query_point = [(radians(coord1["lat"]), radians(coord1["lon"]))]
-            indices = spatial_tree.query_radius(
-                query_point, r=distance_threshold_m / config.earth_radius_m, return_distance=False
-            )
+    return data2
 
-            for indices_for_query in indices:
-                for idx in indices_for_query:
-                    data2.at[idx, "proximity"] = True
 
-            pbar.update(1)
+def _drop_duplicate_coordinates(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Drops entries at the same position as an earlier entry. Positions are compared in integer microdegrees (about 0.1 m),
+    so coordinates that differ only by floating point noise count as duplicates.
+    """
+    lat, lon = _coordinates(data)
+    lat_key = np.round(lat * 1e6).astype(np.int64)
+    lon_key = np.round(lon * 1e6).astype(np.int64)
+    key = (lat_key << 32) | (lon_key & 0xFFFFFFFF)
 
-    return data2
+    _, first_occurrences = np.unique(key, return_index=True)
+    return data.iloc[np.sort(first_occurrences)]
 
 
 def merge_oaip_osm_helipads(
@@ -176,56 +308,31 @@ def merge_oaip_osm_helipads(
     Returns:
         None
     """
+    # drop duplicates within each source before the proximity check so they are not matched twice. An OSM entry at the
+    # position of an OpenAIP entry is always in proximity, so the combined data needs no second deduplication.
+    openaip_data = _drop_duplicate_coordinates(openaip_data).reset_index(drop=True)
+    osm_data = _drop_duplicate_coordinates(osm_data).reset_index(drop=True)
+
     osm_proximity = check_for_proximity(openaip_data, osm_data, max_distance_m)
 
     # combine the data, we always keep the openaip entry
-    data = []
-    for _, openaip_entry in openaip_data.iterrows():
-        data.append(
-            [
-                openaip_entry["lat"],
-                openaip_entry["lon"],
-                openaip_entry["source"],
-                openaip_entry["info_json"],
-            ]
-        )
-    for _, osm_entry in osm_proximity.iterrows():
-        if not osm_entry["proximity"]:
-            data.append(
-                [
-                    osm_entry["lat"],
-                    osm_entry["lon"],
-                    osm_entry["source"],
-                    osm_entry["info_json"],
-                ]
-            )
-
-    # save the data
-    df = pd.DataFrame(
-        data=data,
-        columns=[
-            "lat",
-            "lon",
-            "source",
-            "info_json",
-        ],
+    columns = ["lat", "lon", "source", "info_json"]
+    df = pd.concat(
+        [openaip_data[columns], osm_proximity.loc[~osm_proximity["proximity"], columns]],
+        ignore_index=True,
     )
 
-    # we could have duplicates in the OSM data since we keep all entries that are not matched
-    df.drop_duplicates(subset=["lat", "lon"], inplace=True)
-
     return df
 
 
 if __name__ == "__main__":
-    # filter the openaip data individual jsons for the type we are interested in
-    path_openaip_filtered = os.path.join(config.intermediate_folder, "openaip_filtered")
-    filter_openaip_files_for_type(config.raw_data_openaip_folder, path_openaip_filtered)
+    if not os.path.exists(config.intermediate_folder):
+        os.makedirs(config.intermediate_folder)
 
-    # transform the openaip data into one data file with our own schema
+    # filter the openaip data for the heliports and transform it into one data file with our own schema
     openaip_heli_output_file = os.path.join(config.intermediate_folder, "openaip_transformed.parquet")
     transform_openaip_data(
-        path_openaip_filtered,
+        config.raw_data_openaip_folder,
         openaip_heli_output_file,
     )
 
@@ -233,12 +340,11 @@ if __name__ == "__main__":
     osm_heli_output_file = os.path.join(config.intermediate_folder, "osm_heli.parquet")
     transform_osm_helipad_data(os.path.join(config.raw_data_osm_folder, "heli"), osm_heli_output_file)
 
-    # merge the data
+    # merge the data, the columns stay backed by arrow so the info_json strings are never turned into python objects
     merged_heli_output_file = os.path.join(config.intermediate_folder, "helipads.parquet")
     merged = merge_oaip_osm_helipads(
-        pd.read_parquet(openaip_heli_output_file),
-        pd.read_parquet(osm_heli_output_file),
+        pd.read_parquet(openaip_heli_output_file, dtype_backend="pyarrow"),
+        pd.read_parquet(osm_heli_output_file, dtype_backend="pyarrow"),
         max_distance_m=config.radius_helipad_duplicate_m,
     )
-    merged.to_parquet(merged_heli_output_file)
-    merged.to_csv(merged_heli_output_file.replace(".parquet", ".csv"), index=False)
+    write_table(pa.Table.from_pandas(merged, preserve_index=False), merged_heli_output_file)
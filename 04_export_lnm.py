@@ -1,47 +1,31 @@
 import os
-import re
-import json
 
-from tqdm import tqdm
+import orjson
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 import config
 
 
-def extract_identifier(json_info: dict) -> str:
-    if "icaoCode" in json_info:
-        return json_info["icaoCode"]
-    return ""
+def make_pretty_descriptions(sources: np.ndarray, info: pd.DataFrame) -> pd.Series:
+    # one line per non-empty field, the icaoCode is left out since it is already in the identifier
+    lines = []
+    for key in ["name", "surface", "operator", "description"]:
+        values = info[key].astype(str)
+        lines.append((key.capitalize() + ": " + values + "\n").where(values != "", ""))
+    elevations = info["elevation"].astype(str)
+    lines.append(("Elevation: " + elevations + "m MSL\n").where(elevations != "", ""))
 
+    return lines[0].str.cat(lines[1:]) + "Source: " + pd.Series(sources, index=info.index, dtype=object)
 
-def make_pretty_description(source: str, json_info: dict) -> str:
-    out = ""
-    for key in json_info:
-        if key == "icaoCode":  # already in the name / identifier
-            continue
-        if key == "elevation" and json_info[key] != "":
-            out = out + f"Elevation: {json_info[key]}m MSL\n"
-        else:
-            if json_info[key] != "":
-                out = out + f"{key.capitalize()}: {json_info[key]}\n"
 
-    out = out + f"Source: {source}"
-
-    return out
-
-
-def extract_elevation_in_ft(json_info: dict) -> str:
-    if "elevation" in json_info and json_info["elevation"] != "":
-        # remove all non-digits and convert to ft
-        digits_only = "".join(
-            [
-                char
-                for char in str(json_info["elevation"])
-                if char.isdigit() or char == "." or char == "," or char == "-"
-            ]
-        )
-        return str(float(digits_only) * 3.28084)
-    return ""
+def extract_elevation_in_ft(elevation: pd.Series) -> pd.Series:
+    # remove all non-digits and convert to ft, values without a number stay empty
+    digits_only = elevation.astype(str).str.replace(r"[^0-9.,-]", "", regex=True)
+    elevation_ft = pd.to_numeric(digits_only, errors="coerce") * 3.28084
+    return elevation_ft.astype(str).where(elevation_ft.notna(), "")
 
 
 def create_longitude_boundaries():
@@ -64,15 +48,19 @@ def create_longitude_boundaries():
     }
 
 
-def assign_region(row, boundaries):
-    if boundaries["Region 1"]["Western Boundary"] <= row["Longitude"] < boundaries["Region 1"]["Eastern Boundary"]:
-        return "Region 1"
-    elif boundaries["Region 2"]["Western Boundary"] <= row["Longitude"] < boundaries["Region 2"]["Eastern Boundary"]:
-        return "Region 2"
-    elif boundaries["Region 3"]["Western Boundary"] < row["Longitude"] <= boundaries["Region 3"]["Eastern Boundary"]:
-        return "Region 3"
-    else:
-        raise ValueError(f"Could not assign region to {row['Longitude']}")
+def assign_regions(longitudes: np.ndarray, boundaries: dict) -> np.ndarray:
+    # regions contain their western boundary, the last region also its eastern boundary
+    conditions = [
+        (boundary["Western Boundary"] <= longitudes) & (longitudes < boundary["Eastern Boundary"])
+        for boundary in boundaries.values()
+    ]
+    conditions[-1] |= longitudes == list(boundaries.values())[-1]["Eastern Boundary"]
+
+    regions = np.select(conditions, list(boundaries.keys()), default="")
+    unassigned = regions == ""
+    if unassigned.any():
+        raise ValueError(f"Could not assign region to {longitudes[unassigned][0]}")
+    return regions
 
 
 if __name__ == "__main__":
@@ -82,48 +70,34 @@ if __name__ == "__main__":
     df_input = pd.read_parquet(os.path.join(config.intermediate_folder, "helipads.parquet"))
 
     # now transform the data into the format we need for the LittleNavMap export
-    intermediate_data = []
-    for _, row in tqdm(df_input.iterrows(), total=len(df_input)):
-        json_info = json.loads(row["info_json"])
-        intermediate_data.append(
-            {
-                "Type": "Helipad",
-                "Name": "",
-                "Ident": extract_identifier(json_info),
-                "Latitude": row["lat"],
-                "Longitude": row["lon"],
-                "Elevation": extract_elevation_in_ft(json_info),
-                "Magnetic Declination": "",
-                "Tags": "WorldHelipads",
-                "Description": make_pretty_description(row["source"], json_info),
-                "Region": "",
-                "Visible From": "",
-                "Last Edit": "",
-                "Import Filename": "",
-            }
-        )
+    json_infos = [orjson.loads(info_json) for info_json in df_input["info_json"]]
+    info = pd.DataFrame(
+        json_infos, columns=["icaoCode", "name", "surface", "operator", "description", "elevation"], dtype=object
+    ).fillna("")
 
     df_export = pd.DataFrame(
-        columns=[
-            "Type",
-            "Name",
-            "Ident",
-            "Latitude",
-            "Longitude",
-            "Elevation",
-            "Magnetic Declination",
-            "Tags",
-            "Description",
-            "Region",
-            "Visible From",
-        ],
-        data=intermediate_data,
+        {
+            "Type": "Helipad",
+            "Name": "",
+            "Ident": info["icaoCode"].to_numpy(),
+            "Latitude": df_input["lat"].to_numpy(dtype=np.float64),
+            "Longitude": df_input["lon"].to_numpy(dtype=np.float64),
+            "Elevation": extract_elevation_in_ft(info["elevation"]).to_numpy(),
+            "Magnetic Declination": "",
+            "Tags": "WorldHelipads",
+            "Description": make_pretty_descriptions(df_input["source"].to_numpy(), info).to_numpy(),
+            "Region": "",
+            "Visible From": "",
+        }
     )
 
     # now assign regions to the data
-    df_export["Region"] = df_export.apply(assign_region, axis=1, boundaries=create_longitude_boundaries())
-
-    for region in df_export.Region.unique().tolist():
-        df_export[df_export.Region == region].to_csv(
-            os.path.join(config.export_folder, f"export_lnm_{region}.csv"), index=False, sep=","
+    df_export["Region"] = assign_regions(df_export["Longitude"].to_numpy(), create_longitude_boundaries())
+
+    # split the data into the regions in one pass and write each with arrow's multithreaded csv writer
+    for region, df_region in df_export.groupby("Region", sort=False):
+        pa_csv.write_csv(
+            pa.Table.from_pandas(df_region, preserve_index=False),
+            os.path.join(config.export_folder, f"export_lnm_{region}.csv"),
+            write_options=pa_csv.WriteOptions(quoting_style="needed"),
         )
@@ -6,15 +6,23 @@ raw_data_openaip_folder = os.path.join(raw_data_folder, "openaip")
 raw_data_osm_folder = os.path.join(raw_data_folder, "osm")
 intermediate_folder = os.path.join("data", "intermediate")
 export_folder = os.path.join("data", "export")
+write_debug_csv = False  # additionally write the intermediate parquet files as CSV for inspection
+parquet_compression = "snappy"
+parquet_row_group_size = 100_000  # rows per row group, lets readers skip groups when filtering
 
 # OpenAIP data on google cloud platform
 openaip_storage_bucket = "29f98e10-a489-4c82-ae5e-489dbcd4912f"
 openaip_storage_postfix = "_apt.json"
+openaip_download_workers = 8  # number of parallel file downloads from google storage
 
 # settings to query OSM data,  queries expect a bounding box replacement in the token $bbox$
 osm_query_url = "https://overpass-api.de/api/interpreter"
 num_lat_divisions = 18  # Divide the Earth into 18 equal latitude bands
 num_lon_divisions = 36  # Divide the Earth into 36 equal longitude bands
+osm_download_workers = 4  # number of parallel requests to the Overpass API
+osm_requests_per_second: float = 2  # upper bound for requests started per second across all workers
+osm_cache_file = os.path.join(raw_data_folder, "osm_cache")  # sqlite cache of successful Overpass responses
+osm_cache_expire_after_s = 7 * 24 * 3600
 
 heli_query = '[out:json];(node[aeroway~"helipad|heliport"]($bbox$);way[aeroway~"helipad|heliport"]($bbox$);relation[aeroway~"helipad|heliport"]($bbox$););out center;'
 hospital_query = "[out:json];(node[amenity=hospital]($bbox$);way[amenity=hospital]($bbox$);relation[amenity=hospital]($bbox$););out center;"
@@ -24,6 +32,10 @@ offshore_query = '[out:json];(node[man_made~"offshore_platform|floating_storage"
 radius_helipad_duplicate_m: float = 100
 radius_helipad_belongs_to_hospital_m: float = 500
 radius_helipad_belongs_to_offshore_m: float = 250
+# the proximity check skips the spatial tree only if both limits hold, the brute force loops in Python over the points 1
+proximity_brute_force_max_pairs = 10_000_000  # maximum number of point pairs compared directly
+proximity_brute_force_max_queries = 1_000  # maximum number of points 1, i.e. loop iterations
+proximity_query_workers = -1  # threads used for the spatial tree queries, -1 uses all cores
 
 # physical constants
 earth_radius_m = 6371000  # Earth radius in meters, approximate